@@ -1,9 +1,13 @@
+import aiohttp
+from aiolimiter import AsyncLimiter
 import argparse
+import asyncio
 import datetime as dt
-import json
+import numpy as np
+import orjson
 import os
 import pandas as pd
-import requests
+import shelve
 import time
 from urllib.parse import urlencode
 
@@ -39,6 +43,17 @@ parser.add_argument(
 )
 args = parser.parse_args()
 
+# The API only serves one day per historical request and has no time-series endpoint, so the floor is one
+# request per date. Every request must carry all of the targets; never split a date into per-currency calls
+HISTORICAL_ENDPOINT: str = 'https://exchange-rates.abstractapi.com/v1/historical'
+# The API quota is shared by every in-flight request, so cap the number of concurrent calls
+MAX_CONCURRENT_REQUESTS: int = 3
+# Requests allowed per second by the API quota, and how many times to retry a throttled (HTTP 429) request
+REQUESTS_PER_SECOND: int = 1
+MAX_RETRIES: int = 3
+# Rates that have already been pulled, keyed by base, date and targets, so reruns skip the API calls
+CACHE_FILE: str = '.fx_cache'
+
 
 def validate_inputs(args: argparse.Namespace) -> argparse.Namespace:
     """Validate the inputs from the commmand line
@@ -52,55 +67,59 @@ def validate_inputs(args: argparse.Namespace) -> argparse.Namespace:
     args = vars(args)
     # Validate date types
     if isinstance(args.get('start_date'), str):
-        start_date: dt.datetime = dt.datetime.strptime(args.get('start_date'), '%Y-%m-%d')
+        start_date: dt.date = dt.date.fromisoformat(args.get('start_date'))
 
     if isinstance(args.get('end_date'), str):
-        end_date: dt.datetime = dt.datetime.strptime(args.get('end_date'), '%Y-%m-%d')
+        end_date: dt.date = dt.date.fromisoformat(args.get('end_date'))
         
     # Validate the start date is before the end date. Set default otherwise
     if start_date >= end_date:
         print('The historical start date must be before the historical end date. Setting the start date to 1 day before the historical end date')
-        start_date = dt.strptime(end_date - dt.timedelta(days=1), '%Y-%m-%d')
+        start_date = end_date - dt.timedelta(days=1)
+
+    # Normalise the currency codes, since the API keys its response by upper case codes
+    args['targets'] = ','.join(t.strip().upper() for t in args.get('targets').split(',') if t.strip())
 
     # Reassign the validated dates
     args['start_date'] = start_date
     args['end_date'] = end_date
     return args
     
-def create_set_of_dates(start_date: dt.datetime, end_date: dt.datetime) -> set[str]:
-    """Create a set of dates between the start and end dates, inclusive, to iterate through
+def create_range_of_dates(start_date: dt.date, end_date: dt.date) -> tuple[str, ...]:
+    """Create a sorted tuple of dates between the start and end dates, inclusive, to iterate through
     while making the API calls.
 
     Args:
-        start_date (dt.datetime): The start date
-        end_date (dt.datetime): The end date
+        start_date (dt.date): The start date
+        end_date (dt.date): The end date
 
     Returns:
-        set[str]: A set of dates between the start and end dates, inclusive
+        tuple[str, ...]: The dates between the start and end dates, inclusive, in ascending order
     """
-    dates = []
-    while start_date <= end_date:
-        dates.append(start_date.strftime('%Y-%m-%d'))
-        start_date += dt.timedelta(days=1)
-    return set(dates)
+    return tuple(pd.date_range(start_date, end_date, freq='D').strftime('%Y-%m-%d'))
 
 def return_csv_indicies(filename: str) -> tuple[pd.Index, pd.Index]:
-    """Read the row and column indicies to check for new currency targets and dates
+    """Read the currencies and dates already stored to check for new currency targets and dates
     
     Args:
         filename (str): The name of the file to read
     
     Returns:
-        tuple[pd.Index, pd.Index]: The row and column indicies
+        tuple[pd.Index, pd.Index]: The currencies and the dates in the file. Both are empty if the file doesn't exist yet
     """
-    df = pd.read_csv(filename, 
+    if not os.path.exists(filename):
+        return pd.Index([]), pd.Index([])
+    # Only the key columns are needed, so skip parsing the rates themselves
+    df = pd.read_csv(filename,
                      sep=',',
                      header=0,
-                     index_col=0,
+                     usecols=['date', 'currency'],
+                     dtype=str,
+                     engine='pyarrow',
                 )
-    return df.index, df.columns
+    return pd.Index(df['currency'].unique()), pd.Index(df['date'].unique())
 
-def validate_targets(targets: set, row_index: set) -> set[str]:
+def validate_targets(targets: set, row_index: pd.Index) -> set[str]:
     """Compare the default targets and/or input targets to what is in the CSV file.
     Return a warning if new targets have been found.
     
@@ -111,98 +130,141 @@ def validate_targets(targets: set, row_index: set) -> set[str]:
     Returns:
         None. Print warning if new targets have been added
     """
-    if new_targets := {t for t in targets if t not in row_index}:
+    # Plain set difference rather than probing the pd.Index once per target
+    if new_targets := targets - frozenset(row_index):
         print(f"Warnihg: New targets have been added and will need to be backfilled: {new_targets}")
     return new_targets
 
-def validate_dates(date_range: set, col_index: set) -> set[str]:
+def validate_dates(date_range: tuple[str, ...], col_index: pd.Index) -> list[str]:
     """Compare the default dates and/or input dates to what is in the CSV file.
     Pull historical data only for the new dates.
 
     Args:
-        date_range (set): The dates to validate
+        date_range (tuple[str, ...]): The dates to validate, in ascending order
         col_index (pd.Index): The column index from the CSV file
 
     Returns:
-        set: The new dates to pull historical data for
+        list[str]: The new dates to pull historical data for, in the same order as the date range
     """
-    if new_dates := {d for d in date_range if d not in col_index}:
+    # Probe a frozenset rather than the pd.Index, and keep the comprehension to preserve the order of the dates
+    existing = frozenset(col_index)
+    if new_dates := [d for d in date_range if d not in existing]:
         print(f"Pulling historical data for the following dates: {new_dates}")
     return new_dates
 
-def aggregate_historical_currency_data(base: str, date_range: set, *, targets: set) -> pd.DataFrame:
-    """Create an iterator that controls the API calls to the endpoint. Since the API allows us to retrieve data for one day
-    at a time, we're iterating through a date range and a generator function to combine all of the data.
+async def aggregate_historical_currency_data(base: str, date_range: list[str], *, targets: set) -> pd.DataFrame:
+    """Control the API calls to the endpoint. Since the API allows us to retrieve data for one day
+    at a time, we're sending one request per date concurrently, paced by a rate limiter, and combining all of the data.
     
     Args:
         base (str): The base currency
-        date_range (set): The date range to pull historical data for
+        date_range (list[str]): The date range to pull historical data for, in ascending order
         targets (set): The targets to pull historical data for
 
     Returns:
         pd.DataFrame: The combined historical exchange rates
     """
-    targets: str = ','.join(targets)
-    df: pd.DataFrame = pd.DataFrame()
-    for dr in sorted(list(date_range)):
-        temp_df = next(get_historical_exchange_rates(base, dr, targets))
-        df = pd.concat([df, temp_df], axis=1, ignore_index=False)
-    return df
-
-def get_historical_exchange_rates(base: str, date: dt.datetime, targets: str) -> pd.DataFrame:
-    """Generator function to pull historical exchange rate for a given date and currency codes
+    # Sort the targets so the same set always produces the same cache key
+    targets_str: str = ','.join(sorted(targets))
+    limiter = AsyncLimiter(max_rate=REQUESTS_PER_SECOND, time_period=1)
+    # Size the keep-alive pool to the concurrency so each slot reuses its TCP/TLS connection
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS, keepalive_timeout=30)
+    with shelve.open(CACHE_FILE) as cache:
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as session:
+            results = await asyncio.gather(
+                *[get_historical_exchange_rates(session, limiter, cache, base, dr, targets_str) for dr in date_range]
+            )
+    # Skip the dates whose response lacks a requested rate instead of storing empty rows for them.
+    # Nothing is written for those dates, so they are pulled again on the next run
+    currencies = sorted(targets)
+    complete: list[tuple[str, dict[str, float]]] = []
+    for dr, rates in zip(date_range, results):
+        if missing := {c for c in currencies if rates.get(c) is None}:
+            print(f"Warning: The response for {dr} is missing {missing}. Skipping the date, it will be pulled again on the next run")
+            continue
+        if unexpected := rates.keys() - targets:
+            print(f"Warning: The response for {dr} contains unexpected currencies, which will be ignored: {unexpected}")
+        complete.append((dr, rates))
+    # Fill a single currencies x dates buffer column by column and wrap it in a frame once.
+    # It stays float64, as float32 can't hold the eight significant digits of rates such as PHP near 55
+    arr = np.full((len(currencies), len(complete)), np.nan, dtype=np.float64)
+    for j, (_, rates) in enumerate(complete):
+        for i, ccy in enumerate(currencies):
+            arr[i, j] = rates[ccy]
+    return pd.DataFrame(arr, index=currencies, columns=[dr for dr, _ in complete])
+
+async def get_historical_exchange_rates(session: aiohttp.ClientSession, limiter: AsyncLimiter, cache: shelve.Shelf, base: str, date: str, targets: str) -> dict[str, float]:
+    """Pull historical exchange rate for a given date and all of the currency codes in a single request
     
     Args:
+        session (aiohttp.ClientSession): The session shared by all of the requests
+        limiter (AsyncLimiter): The rate limiter shared by all of the requests
+        cache (shelve.Shelf): The on-disk cache of rates that have already been pulled
         base (str): The base currency
-        date (dt.datetime): The date to pull historical data for
-        targets (str): The currency codes to pull historical data for
+        date (str): The date to pull historical data for, formatted as YYYY-MM-DD
+        targets (str): The comma separated currency codes to pull historical data for
 
     Raises:
-        requests.ClientError: If there is an error with the request
+        aiohttp.ClientError: If there is an error with the request, it returns an error status, or it is still throttled after the retries
 
-    Yields:
-        pd.DataFrame: The historical exchange rates for a single date
+    Returns:
+        dict[str, float]: The historical exchange rates for a single date, keyed by currency code
     """
+    key = f"{base}:{date}:{targets}"
+    if key in cache:
+        return cache[key]
     try:
-        url = 'https://exchange-rates.abstractapi.com/v1/historical'
+        url = HISTORICAL_ENDPOINT
         params = dict(
                 api_key=os.environ['ABSTRACTAPI_API_KEY'],
                 base= base,
                 date=date,
                 target=targets
             )
-        print(f"Sending request to {url}?{urlencode(params)}")
-        response = requests.request(
-            "GET", 
-            url=url, 
-            params=params, 
-            timeout=30
-        )
-    except requests.ClientError as e:
+        for attempt in range(MAX_RETRIES + 1):
+            # Only blocks once the quota for the current period has been used up
+            async with limiter:
+                print(f"Sending request to {url}?{urlencode(params)}")
+                async with session.get(url, params=params) as response:
+                    if response.status != 429:
+                        # Raise on any other error status instead of parsing its body as rates
+                        response.raise_for_status()
+                        # Keep the raw bytes; orjson parses them without decoding to str first
+                        content = await response.read()
+                        break
+                    retry_after = response.headers.get('Retry-After', '')
+            if attempt == MAX_RETRIES:
+                response.raise_for_status()
+            # Back off for as long as the API asks. Retry-After may also be an HTTP date, so fall back to one period
+            delay = float(retry_after) if retry_after.isdigit() else 1
+            print(f"Request for {date} was throttled. Retrying in {delay}s")
+            await asyncio.sleep(delay)
+    except aiohttp.ClientError as e:
         raise e
     else:
-        response = json.loads(response.text)
-        rates = response['exchange_rates']
-        df = pd.DataFrame.from_dict(rates, orient='index', columns=[f"{date}"])
-        time.sleep(3)
-    yield df
-
-def concatenate_dfs(existing_csv: str, new_df: pd.DataFrame):
-    """Concatenate the existing CSV file with the new historical exchange rates
+        rates = orjson.loads(content)['exchange_rates']
+        # Only cache complete responses, so a date missing a rate is requested again on the next run
+        if all(rates.get(t) is not None for t in targets.split(',')):
+            cache[key] = rates
+    return rates
+
+def append_to_csv(filename: str, new_df: pd.DataFrame):
+    """Append the new historical exchange rates to the CSV file in long form, one row per date and currency.
+    Only the new rows are written, and the header is written when the file is first created.
+    Read the table back in the wide layout with `pd.read_csv(filename).pivot(index='currency', columns='date', values='rate')`
     
     Args:
-        existing_csv (str): The existing CSV file
-        new_df (pd.DataFrame): The new historical exchange rates
-
-    Returns:
-        pd.DataFrame: The concatenated historical exchange rates
+        filename (str): The CSV file to append to
+        new_df (pd.DataFrame): The new historical exchange rates, with currencies as rows and dates as columns
     """
-    existing = pd.read_csv(existing_csv,
-                        sep=',',
-                        header=0,
-                        index_col=0,
-                    )
-    return pd.concat([existing, new_df], axis=1)
+    rows = new_df.rename_axis('currency').reset_index().melt(id_vars='currency', var_name='date', value_name='rate')
+    rows[['date', 'currency', 'rate']].to_csv(filename,
+                                              sep=',',
+                                              mode='a',
+                                              header=not os.path.exists(filename),
+                                              index=False,
+                                              encoding='utf-8',
+                                        )
 
 
 if __name__ == "__main__":
@@ -211,18 +273,17 @@ if __name__ == "__main__":
     print(f"Starting to pull historical data for {args.get('targets')} between the dates {args.get('start_date')} and {args.get('end_date')}")
 
     filename: str = 'exchange_rates_table.csv'
-    historical_start_date: str = args.get('start_date')
-    historical_end_date:str = args.get('end_date')
-    date_range: set = create_set_of_dates(historical_start_date, historical_end_date)
+    historical_start_date: dt.date = args.get('start_date')
+    historical_end_date: dt.date = args.get('end_date')
+    date_range: tuple[str, ...] = create_range_of_dates(historical_start_date, historical_end_date)
 
     targets: set[str] = set(args.get('targets').split(','))
     row_index, col_index = return_csv_indicies(filename)
     validate_targets(targets, row_index)
-    valid_date_range: set = validate_dates(date_range, col_index)
+    valid_date_range: list[str] = validate_dates(date_range, col_index)
 
     base_currency = 'USD'
-    df_from_api: pd.DataFrame = aggregate_historical_currency_data(base_currency, valid_date_range, targets=targets)
-    final_df: pd.DataFrame = concatenate_dfs('exchange_rates_table.csv', df_from_api)
-    final_df.to_csv(filename, sep=',', header=True, index=True, encoding='utf-8')
+    df_from_api: pd.DataFrame = asyncio.run(aggregate_historical_currency_data(base_currency, valid_date_range, targets=targets))
+    append_to_csv(filename, df_from_api)
     print("Job complete. CSV file updated.")
     print(f"Finished the job in {time.perf_counter() - start}s.")